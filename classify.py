@@ -1,13 +1,12 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 import argparse
 import sys
 import glob
-from gfn import (GFNs_from_filenames,
-                 GFN_from_filename)
+from gfn import GFNs_from_filenames
 from util import (group_by_attributes,
                   save_csv,
                   read_csv,
-                  is_blacklisted)
+                  is_blocklisted)
 
 DESCRIPTION = "Compute the weight value for all given font files."
 parser = argparse.ArgumentParser(description=DESCRIPTION)
@@ -28,13 +27,16 @@ def main():
   files_to_process = []
   for pattern in args.files:
     files_to_process.extend(glob.glob(pattern))
+  # overlapping patterns may match the same file more than once:
+  files_to_process = sorted(set(files_to_process))
 
   old_metadata = read_csv(args.input)
   print("There are {} entries in the old metadata CSV.".format(len(old_metadata.keys())))
 
-  blacklisted = [fname for fname in files_to_process if is_blacklisted(fname)]
-  files_to_process = [fname for fname in files_to_process if not is_blacklisted(fname) and \
-                                                             GFN_from_filename(fname) in old_metadata.keys()]
+  blacklisted = [fname for fname in files_to_process if is_blocklisted(fname)]
+  files_to_process = [fname for fname in files_to_process if not is_blocklisted(fname)]
+  GFNs = GFNs_from_filenames(files_to_process)
+  files_to_process = [fname for fname in files_to_process if GFNs[fname] in old_metadata]
 
   if blacklisted:
     print ("{} font files were blacklisted:\n".format(len(blacklisted)))
@@ -46,14 +48,13 @@ def main():
     print("Will process {} font files.".format(len(files_to_process)))
 
 
-  fonts = [(fname, old_metadata[GFN_from_filename(fname)]['subsets']) for fname in files_to_process]
+  fonts = [(fname, old_metadata[GFNs[fname]]['subsets']) for fname in files_to_process]
   weights, widths = group_by_attributes(fonts)
-  GFNs = GFNs_from_filenames(files_to_process)
 
   metadata = {}
   for fname in files_to_process:
     gfn = GFNs[fname]
-    if gfn in old_metadata.keys():
+    if gfn in old_metadata:
       metadata[gfn] = old_metadata[gfn] # preserve every old value
       metadata[gfn]['weight_int'] = weights[fname] # except the new weight 
       metadata[gfn]['width_int'] = widths[fname] # and width values we have just computed
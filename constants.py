@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # Copyright 2016 The Fontbakery Authors
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # coding: utf-8
 # Copyright 2013 The Font Bakery Authors. All Rights Reserved.
 # Copyright 2017 The Google Font Tools Authors
@@ -26,21 +26,27 @@
 # font-classification-tool.py -h
 #
 import argparse
+import base64
 import collections
 import csv
 import glob
+import io
 import math
+import multiprocessing
 import os
-import StringIO
+import struct
 import sys
 import re
+import threading
 import errno
+import zlib
 from fonts_public_pb2 import FamilyProto
 from constants import (NAMEID_FONT_FAMILY_NAME,
                        NAMEID_FONT_SUBFAMILY_NAME)
-from gfn import GFN_from_filename
+from gfn import GFNs_from_filenames
 
 import cairo
+import numpy as np
 from util import create_cairo_font_face_for_file, PycairoContext
 
 
@@ -85,27 +91,53 @@ except:
   sys.exit("Needs flask.\n\npip install flask")
 
 
-# At some point we may want to regenerate these images using cairo code
-# but for now I think it is enough to simply usethe generated PNGs commited to the git repo.
-#
-#def generate_italic_angle_images():
-#  for i in range(10):
-#    angle = 30*(float(i)/10) * 3.1415/180
-#    width = 2000
-#    height = 500
-#    lines = 250
-#    im = Image.new('RGBA', (width,height), (255,255,255,0))
-#    spacing = width/lines
-#    draw = ImageDraw.Draw(im)
-#    for j in range(lines):
-#      draw.line([j*spacing - 400, im.size[1], j*spacing - 400 + im.size[1]*math.tan(angle), 0], fill=(50,50,255,255))
-#    del draw
-#
-#    imagesdir = os.path.join(os.path.dirname(__file__), "font_classification_tool", "images")
-#    if not os.path.isdir(imagesdir):
-#       os.mkdir(imagesdir)
-#    filepath = os.path.join(imagesdir, "angle_{}.png".format(i+1))
-#    im.save(filepath, "PNG")
+def write_rgba_png(filepath, pixels):
+  """Saves a (height, width, 4) uint8 array of RGBA pixels as a PNG file."""
+  height, width, _ = pixels.shape
+  scanlines = np.zeros((height, 1 + 4*width), dtype=np.uint8) # filter type 0 on every row
+  scanlines[:, 1:] = pixels.reshape(height, 4*width)
+
+  def chunk(tag, data):
+    return (struct.pack(">I", len(data)) + tag + data +
+            struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+  with open(filepath, "wb") as pngfile:
+    pngfile.write(b"\x89PNG\r\n\x1a\n")
+    pngfile.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+    pngfile.write(chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 9)))
+    pngfile.write(chunk(b"IEND", b""))
+
+
+def generate_italic_angle_images():
+  """Generates the reference images for each italic angle score
+     shown on the web UI. Existing images are left untouched."""
+  imagesdir = os.path.join(os.path.dirname(__file__), "font_classification_tool", "images")
+  if os.path.exists(os.path.join(imagesdir, "angle_10.png")):
+    return
+
+  if not os.path.isdir(imagesdir):
+    os.mkdir(imagesdir)
+
+  width = 2000
+  height = 500
+  lines = 250
+  spacing = width // lines
+  # Line j goes from (j*spacing - 400, height) up to (j*spacing - 400 + height*tan(angle), 0).
+  # Every line is traced at once, reproducing the integer Bresenham steps
+  # (endpoints included) that PIL's draw.line used for the committed images:
+  x_bottom = np.arange(lines) * spacing - 400
+  steps = np.arange(height + 1)[:, np.newaxis]
+  y = np.broadcast_to(height - steps, (height + 1, lines))
+  for i in range(10):
+    angle = 30*(float(i)/10) * 3.1415/180
+    x_top = (x_bottom + height*math.tan(angle)).astype(int)
+    x = x_bottom + (2*(x_top - x_bottom)*steps + height) // (2*height)
+    visible = (x >= 0) & (x < width) & (y < height)
+
+    im = np.empty((height, width, 4), dtype=np.uint8)
+    im[...] = (255, 255, 255, 0)
+    im[y[visible], x[visible]] = (50, 50, 255, 255)
+    write_rgba_png(os.path.join(imagesdir, "angle_{}.png".format(i+1)), im)
 
 
 def normalize_values(properties, target_max=1.0):
@@ -122,10 +154,8 @@ def map_to_int_range(values, target_min=1, target_max=10):
   """Maps a list into the integer range from target_min to target_max
      Pass a list of floats, returns the list as ints
      The 2 lists are zippable"""
-  integer_values = []
-  values_ordered = sorted(values)
-  min_value = float(values_ordered[0])
-  max_value = float(values_ordered[-1])
+  min_value = float(min(values))
+  max_value = float(max(values))
 
   if min_value == max_value:
     #convert to integer and clamp between min and max
@@ -136,10 +166,8 @@ def map_to_int_range(values, target_min=1, target_max=10):
 
   target_range = (target_max - target_min)
   float_range = (max_value - min_value)
-  for value in values:
-    value = target_min + int(target_range * ((value - min_value) / float_range))
-    integer_values.append(value)
-  return integer_values
+  return [target_min + int(target_range * ((value - min_value) / float_range))
+          for value in values]
 
 
 def get_angle(ttfont):
@@ -152,13 +180,12 @@ FONT_SIZE=30
 # The text used to test weight and width. Note that this could be
 # problematic if a given font doesn't have latin support.
 LATIN_TEXT = "AaBbCcDdEeFfGgHhIiJjKkLlMmNnOoPpQqRrSsTtUuVvXxYyZz"
-KHMER_TEXT = "\xE1\x9E\x9A\xE1\x9E\x9B\xE1\x9E\x80\xE1\x9E\x94\xE1\x9E\x80\xE1\x9F\x8B\xE1\x9E\x94\xE1\x9F\x84\xE1\x9E\x80\xE1\x9E\x93\xE1\x9E\xB6\xE1\x9E\x9B\xE1\x9F\x92\xE1\x9E\x84\xE1\x9E\xB6\xE1\x9E\x85\xE1\x9E\x8A\xE1\x9F\x8F\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x84\xE1\x9E\x85\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x82\xE1\x9E\x84"
+KHMER_TEXT = "រលកបក់បោកនាល្ងាចដ៏កណ្តោចកណ្តែង"
 
 
-img_counter=0
-def render_single_line(fontfile, khmer=False):
-  global img_counter
-
+def render_single_line(fontfile, khmer, img_index):
+  """Renders a sample line of text set in the given font
+     as images/<img_index>.png and returns an <img> tag for it."""
   if khmer:
     sample_text = KHMER_TEXT
   else:
@@ -187,10 +214,9 @@ def render_single_line(fontfile, khmer=False):
 
   del ctx
 
-  img_counter += 1
   try:
-    surface.write_to_png("font_classification_tool/images/{}.png".format(img_counter))
-    return "<img height='50%%' src='font_classification_tool/images/{}.png' />".format(img_counter)
+    surface.write_to_png("font_classification_tool/images/{}.png".format(img_index))
+    return "<img height='50%%' src='font_classification_tool/images/{}.png' />".format(img_index)
   except:
     print ("Cairo failed to write PNG file for {}".format(fontfile))
     return ""
@@ -198,9 +224,9 @@ def render_single_line(fontfile, khmer=False):
 def get_base64_image(img):
   """Get the base 64 representation of an image,
      to use for visual testing."""
-  output = StringIO.StringIO()
+  output = io.BytesIO()
   img.save(output, "PNG")
-  base64img = output.getvalue().encode("base64")
+  base64img = base64.b64encode(output.getvalue()).decode("ascii")
   output.close()
   return base64img
 
@@ -216,6 +242,8 @@ def main():
   files_to_process = []
   for pattern in args.files:
     files_to_process.extend(glob.glob(pattern))
+  # overlapping patterns may match the same file more than once:
+  files_to_process = sorted(set(files_to_process))
 
   if len(files_to_process) == 0:
     sys.exit("No font files were found!")
@@ -238,10 +266,24 @@ def main():
             "img_weight": None
           }
 
-  for fname in files_to_process:
-    gfn = GFN_from_filename(fname)
-    if gfn in fontinfo.keys():
-      fontinfo[gfn]['img_weight'] = render_single_line(fname, "khmer" in fontinfo[gfn]['subsets'])
+  # GFNs are only needed here to attach sample images to the existing
+  # entries, and those images are only shown on the web UI, so there's
+  # no point in doing any of this in debug mode:
+  if not args.debug:
+    GFNs = GFNs_from_filenames(files_to_process)
+    previews = [(fname, GFNs[fname]) for fname in files_to_process
+                if GFNs[fname] in fontinfo]
+
+    # The sample images are rendered in separate processes rather than
+    # threads, as every cairo font face shares util's FreeType library
+    # handle, which must not be used from several threads at once:
+    with multiprocessing.Pool() as pool:
+      images = pool.starmap(render_single_line,
+                            [(fname, "khmer" in fontinfo[gfn]['subsets'], img_index)
+                             for img_index, (fname, gfn) in enumerate(previews, 1)])
+
+    for (fname, gfn), img_weight in zip(previews, images):
+      fontinfo[gfn]['img_weight'] = img_weight
       # TODO: fontinfo[gfn]["weight"]
       # TODO: "width" = width
       # TODO: "angle" = angle
@@ -251,6 +293,15 @@ def main():
   if fontinfo == {}:
     sys.exit("All specified fonts are blacklisted!")
 
+  if args.debug:
+    for gfn in sorted(fontinfo.keys()):
+      values = fontinfo[gfn]
+      print ("{}: weight_int={} width_int={} angle_int={} usage={}".format(gfn,
+                                                                           values['weight_int'],
+                                                                           values['width_int'],
+                                                                           values['angle_int'],
+                                                                           values['usage']))
+    return
 
 
   # generate data for the web server
@@ -272,33 +323,35 @@ def main():
     ],
     "data": []
   }
-  #generate_italic_angle_images()
+  generate_italic_angle_images()
 
-  field_id = 1
-  for key in fontinfo:
+  # grid rows are kept sorted by GFN so that save_csv() can write them as they are:
+  grid_data["data"] = [None] * len(fontinfo)
+  for index, key in enumerate(sorted(fontinfo.keys())):
     values = fontinfo[key]
-    img_weight_html = ""
-    if values["img_weight"] is not None:
-      img_weight_html = values["img_weight"]
-    #  img_weight_html = "<img height='50%%' src='data:image/png;base64,%s' />" % (values["img_weight"])
+    values["image"] = values["img_weight"] or ""
+    #  values["image"] = "<img height='50%%' src='data:image/png;base64,%s' />" % (values["img_weight"])
+    grid_data["data"][index] = {"id": index + 1, "values": values}
+
+  # row ids never change, so /update can find its row without a scan:
+  rows_by_id = {row["id"]: row for row in grid_data["data"]}
 
-    values["image"] = img_weight_html
-    grid_data["data"].append({"id": field_id, "values": values})
-    field_id += 1
+  # Flask serves requests on multiple threads, so edits to the grid
+  # (and the CSV saves that follow them) must not overlap with each other
+  # or with /data.json reading it:
+  grid_lock = threading.Lock()
 
   def save_csv():
     filename = args.output
-    with open(filename, 'w') as csvfile:
+    rows = [[values['gfn'],
+             values['weight_int'],
+             values['angle_int'],
+             values['width_int'],
+             values['usage']] for values in (data['values'] for data in grid_data['data'])]
+    with open(filename, 'w', buffering=1<<20) as csvfile:
         writer = csv.writer(csvfile, delimiter=',', quotechar='"', lineterminator='\n')
         writer.writerow(["GFN","FWE","FIA","FWI","USAGE"]) # first row has the headers
-        for data in sorted(grid_data['data'], key=lambda d: d['values']['gfn']):
-          values = data['values']
-          gfn = values['gfn']
-          fwe = values['weight_int']
-          fia = values['angle_int']
-          fwi = values['width_int']
-          usage = values['usage']
-          writer.writerow([gfn, fwe, fia, fwi, usage])
+        writer.writerows(rows)
     return 'ok'
 
   app = Flask(__name__)
@@ -312,17 +365,25 @@ def main():
 
   @app.route('/data.json')
   def json_data():
-    return jsonify(grid_data)
+    with grid_lock:
+      return jsonify(grid_data)
 
   @app.route('/update', methods=['POST'])
   def update():
     rowid = request.form['id']
     newvalue = request.form['newvalue']
     colname = request.form['colname']
-    for row in grid_data["data"]:
-      if row['id'] == int(rowid):
-        row['values'][colname] = newvalue
-    return save_csv()
+    with grid_lock:
+      row = rows_by_id.get(int(rowid))
+      if row is None:
+        return 'unknown row id: {}'.format(rowid), 400
+      row['values'][colname] = newvalue
+      if colname == 'gfn':
+        # renaming a GFN is the only edit that can break the row ordering,
+        # so swap in a sorted copy rather than sorting the list other
+        # requests may be reading:
+        grid_data["data"] = sorted(grid_data["data"], key=lambda d: d['values']['gfn'])
+      return save_csv()
 
 #  if blacklisted:
 #    print ("{} blacklisted font files:\n".format(len(blacklisted)))
@@ -22,8 +22,13 @@
 # Further improved by Dave Crossland and Felipe Sanches.
 #
 import os
+import re
 import sys
 import collections
+import errno
+import glob
+import multiprocessing
+from functools import lru_cache
 from fonts_public_pb2 import FamilyProto
 from constants import (NAMEID_FONT_FAMILY_NAME,
                        NAMEID_FONT_SUBFAMILY_NAME)
@@ -39,9 +44,12 @@ except:
   sys.exit("Needs protobuf.\n\npip3 install protobuf")
 
 
+# Sibling fonts share a single METADATA.pb, so we only parse each one once:
+@lru_cache(maxsize=1024)
 def get_FamilyProto_Message(path):
     message = FamilyProto()
-    text_data = open(path, "rb").read()
+    with open(path, "rb") as f:
+      text_data = f.read()
     text_format.Merge(text_data, message)
     return message
 
@@ -61,10 +69,20 @@ _KNOWN_WEIGHTS = collections.OrderedDict([
     ('Black', 900)
 ])
 
+# Sort order of styles within a given weight (normal first)
+_STYLE_ORDER = {'normal': 0, 'italic': 1}
+
 FileFamilyStyleWeightTuple = collections.namedtuple(
     'FileFamilyStyleWeightTuple', ['file', 'family', 'style', 'weight'])
 
+# Regexes used by FamilyName and FileFamilyStyleWeight:
+_UPPER_WORD_RE = re.compile('(.)([A-Z][a-z]+)')
+_TRAILING_DIGITS_RE = re.compile('([a-z])([0-9]+)')
+_CAMEL_CASE_RE = re.compile('([a-z0-9])([A-Z])')
+_FAMILY_WEIGHT_RE = re.compile(r'([^/-]+)-(\w+)\.ttf$')
+
 
+@lru_cache(maxsize=None)
 def StyleWeight(styleweight):
   """Breaks apart a style/weight specifier into a 2-tuple of (style, weight).
 
@@ -79,6 +97,7 @@ def StyleWeight(styleweight):
   return ('normal', _KNOWN_WEIGHTS[styleweight])
 
 
+@lru_cache(maxsize=None)
 def FamilyName(fontname):
   """Attempts to build family name from font name.
 
@@ -90,17 +109,18 @@ def FamilyName(fontname):
     The name of the family that should be in this font.
   """
   # SomethingUpper => Something Upper
-  fontname = re.sub('(.)([A-Z][a-z]+)', r'\1 \2', fontname)
+  fontname = _UPPER_WORD_RE.sub(r'\1 \2', fontname)
   # Font3 => Font 3
-  fontname = re.sub('([a-z])([0-9]+)', r'\1 \2', fontname)
+  fontname = _TRAILING_DIGITS_RE.sub(r'\1 \2', fontname)
   # lookHere => look Here
-  return re.sub('([a-z0-9])([A-Z])', r'\1 \2', fontname)
+  return _CAMEL_CASE_RE.sub(r'\1 \2', fontname)
 
 
 class ParseError(Exception):
   """Exception used when parse failed."""
 
 
+@lru_cache(maxsize=None)
 def FileFamilyStyleWeight(filename):
   """Extracts family, style, and weight from Google Fonts standard filename.
 
@@ -112,7 +132,7 @@ def FileFamilyStyleWeight(filename):
     ParseError: if file can't be parsed.
   """
 
-  m = re.search(r'([^/-]+)-(\w+)\.ttf$', filename) #FAMILY_WEIGHT_REGEX
+  m = _FAMILY_WEIGHT_RE.search(filename)
   if not m:
     raise ParseError('Could not parse %s' % filename)
 
@@ -123,6 +143,7 @@ def FileFamilyStyleWeight(filename):
                                     sw[1])
 
 
+@lru_cache(maxsize=1024)
 def _FileFamilyStyleWeights(fontdir):
   """Extracts file, family, style, weight 4-tuples for each font in dir.
 
@@ -145,9 +166,7 @@ def _FileFamilyStyleWeights(fontdir):
     raise OSError(errno.ENOENT, 'no font files found')
 
   result = [FileFamilyStyleWeight(f) for f in files]
-  def _Cmp(r1, r2):
-    return cmp(r1.weight, r2.weight) or -cmp(r1.style, r2.style)
-  result = sorted(result, _Cmp)
+  result.sort(key=lambda r: (r.weight, _STYLE_ORDER[r.style]))
 
   family_names = {i.family for i in result}
   if len(family_names) > 1:
@@ -158,8 +177,6 @@ def _FileFamilyStyleWeights(fontdir):
 
 
 def GFN_from_filename(fontfile):
-  ttfont = TTFont(fontfile)
-
   gfn = "unknown"
   fontdir = os.path.dirname(fontfile)
   metadata = os.path.join(fontdir, "METADATA.pb")
@@ -184,12 +201,14 @@ def GFN_from_filename(fontfile):
     # to auto-detect the GFN value. As a last resort
     # we'll try to extract the info from the NAME table entries.
     try:
-      for entry in ttfont['name'].names:
-        if entry.nameID == NAMEID_FONT_FAMILY_NAME:
-          family = entry.string.decode(entry.getEncoding()).encode('ascii', 'ignore').strip()
-        if entry.nameID == NAMEID_FONT_SUBFAMILY_NAME:
-          style, weight = StyleWeight(entry.string.decode(entry.getEncoding()).encode('ascii', 'ignore').strip())
-      ttfont.close()
+      # Only the name table is needed, so there's no point in
+      # opening the font file at all until we get here:
+      with TTFont(fontfile, lazy=True) as ttfont:
+        for entry in ttfont['name'].names:
+          if entry.nameID == NAMEID_FONT_FAMILY_NAME:
+            family = entry.toUnicode().encode('ascii', 'ignore').decode('ascii').strip()
+          if entry.nameID == NAMEID_FONT_SUBFAMILY_NAME:
+            style, weight = StyleWeight(entry.toUnicode().encode('ascii', 'ignore').decode('ascii').strip())
       if family != "": #avoid empty string in cases of misbehaved family names in the name table
         gfn = "{}:{}:{}".format(family, style, weight)
         if VERBOSE:
@@ -212,7 +231,16 @@ def GFN_from_filename(fontfile):
   return gfn
 
 def GFNs_from_filenames(filenames):
-  return {fname: GFN_from_filename(fname) for fname in filenames}
+  """Detects the GFN of each font file, spreading the work across all CPU cores.
+
+  Returns a dict filename:GFN
+  """
+  # sorting keeps fonts of the same family next to each other,
+  # so that they tend to be handled by the same worker process:
+  filenames = sorted(filenames)
+  with multiprocessing.Pool() as pool:
+    gfns = pool.map(GFN_from_filename, filenames, chunksize=8)
+  return dict(zip(filenames, gfns))
 
 
 def get_GFNs_from_gfonts(apikey):
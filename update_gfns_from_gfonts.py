@@ -28,7 +28,7 @@ def main():
   gfonts_GFNs = get_GFNs_from_gfonts(args.apikey)
 
   # Then we remove the fonts that are not on GFonts nowadays:
-  for gfn in metadata.keys():
+  for gfn in list(metadata.keys()):
     if gfn not in gfonts_GFNs:
       del metadata[gfn]
 
@@ -1,15 +1,106 @@
 #!/usr/bin/env python3
 import csv
-from math import floor
+import hashlib
+import multiprocessing
+import os
+import re
+import sqlite3
 import sys
+import numpy as np
 
 
-def find_extremes(d):
-  """ Input: a dict key:value
-      Output: min and max values from all elements in the dict
+def normalize_scores(values):
+  """ Input: a list of numeric values
+      Output: a list of integer scores from 1 (lowest) to 10 (highest),
+              in the same order as the input values
   """
-  values = d.values()
-  return min(values), max(values)
+  values = np.asarray(values, dtype=np.float64)
+  min_value = values.min()
+  value_range = values.max() - min_value
+
+  if value_range == 0: # unlikely
+    return [5] * len(values)
+
+  scores = 1 + np.floor(10 * ((values - min_value) / value_range))
+  return np.minimum(scores, 10).astype(int).tolist()
+
+
+def font_file_digest(filename):
+  """ Returns a hex digest identifying the contents of a font file.
+
+      Only the file size and its first 64KiB are hashed. That covers the
+      sfnt table directory, whose per-table checksums change whenever
+      any of the font data does.
+  """
+  with open(filename, 'rb') as fontfile:
+    digest = hashlib.blake2b(fontfile.read(65536), digest_size=16)
+  digest.update(str(os.path.getsize(filename)).encode('ascii'))
+  return digest.hexdigest()
+
+
+# Darkness and width measurements are kept on disk between runs,
+# keyed by font file path, modification time and size:
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache",
+                          "font-classification-tool", "cache.sqlite")
+
+# Bump this whenever compute_darkness_and_width changes the way it measures
+# fonts, so that measurements taken by older code are not reused:
+MEASUREMENT_REVISION = 1
+
+def _measurements_table():
+  """Name of the cache table holding measurements taken with the current
+     revision, font size and sample texts."""
+  parameters = repr((MEASUREMENT_REVISION, FONT_SIZE, LATIN_TEXT, KHMER_TEXT))
+  return "measurements_" + hashlib.sha1(parameters.encode('utf-8')).hexdigest()[:16]
+
+
+def open_measurements_cache(filename=CACHE_FILE):
+  """Opens the on-disk cache of font measurements, creating it if needed.
+     Returns None if the cache can't be used, in which case all fonts
+     simply get measured again."""
+  cache = None
+  try:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    cache = sqlite3.connect(filename)
+    cache.execute("CREATE TABLE IF NOT EXISTS {} ("
+                  "  path TEXT, subsets TEXT, mtime INTEGER, size INTEGER,"
+                  "  darkness REAL, width REAL,"
+                  "  PRIMARY KEY (path, subsets))".format(_measurements_table()))
+    return cache
+  except (OSError, sqlite3.Error) as e:
+    print("Not using the measurements cache at {}: {}".format(filename, e))
+    if cache is not None:
+      cache.close()
+    return None
+
+
+def get_cached_measurement(cache, fontfile, subsets, stat):
+  """Returns the cached (darkness, width) of a font file, or None if it was
+     never measured or has changed since then. 'stat' is the os.stat() of
+     the font file as it is about to be used."""
+  try:
+    return cache.execute("SELECT darkness, width FROM {}"
+                         " WHERE path=? AND subsets=? AND mtime=? AND size=?".format(_measurements_table()),
+                         (os.path.abspath(fontfile), subsets or '',
+                          stat.st_mtime_ns, stat.st_size)).fetchone()
+  except sqlite3.Error:
+    return None
+
+
+def store_measurement(cache, fontfile, subsets, stat, values):
+  """Saves the (darkness, width) of a font file on the cache, under the
+     os.stat() taken before it was measured."""
+  darkness, width = values
+  cache.execute("INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?, ?)".format(_measurements_table()),
+                (os.path.abspath(fontfile), subsets or '',
+                 stat.st_mtime_ns, stat.st_size,
+                 float(darkness), float(width)))
+
+
+def _darkness_and_width_worker(font):
+  """Pool worker: computes darkness and width for a (filename, subsets) pair."""
+  name, subsets = font
+  return name, compute_darkness_and_width(name, subsets)
 
 
 def group_by_attributes(fonts):
@@ -22,43 +113,71 @@ def group_by_attributes(fonts):
       Output: a dict filename:value
               where value is a weight score from 1 (lightest) to 10 (darkest)
   """
-  darkness = {}
-  width = {}
+  # Files are stat'ed once, before anything gets measured, so that a font
+  # modified while the pool runs is not stored as up to date.
+  # SQLite connections must not be carried across the fork() that
+  # starts the worker pool, so the cache is closed while it runs:
+  stats = {name: os.stat(name) for name, subsets in fonts}
+  measured = {}
+  missing = []
+  cache = open_measurements_cache()
   for name, subsets in fonts:
-    darkness[name], width[name] = compute_darkness_and_width(name, subsets)
-
-  # normalize weight values:
-  min_dark, max_dark = find_extremes(darkness)
-  dark_range = max_dark - min_dark
-
-  if dark_range == 0: # unlikely
-    weights = {name: 5 for name, _ in fonts}
-  else:
-    weights = {}
-    for name, _ in fonts:
-      weights[name] = min(10, int(1 + floor(10 * ((darkness[name] - min_dark)/ dark_range))))
-
-  # normalize width values:
-  min_width, max_width = find_extremes(width)
-  width_range = max_width - min_width
-
-  if width_range == 0: # unlikely
-    widths = {name: 5 for name, _ in fonts}
-  else:
-    widths = {}
-    for name, _ in fonts:
-      widths[name] = min(10, int(1 + floor(10 * ((width[name] - min_width)/ width_range))))
-
+    values = None
+    if cache is not None:
+      values = get_cached_measurement(cache, name, subsets, stats[name])
+    if values is None:
+      missing.append((name, subsets))
+    else:
+      measured[name] = values
+  if cache is not None:
+    cache.close()
+
+  # Identical font files (such as copies of a family in mirrored
+  # directories) only need to be rendered once:
+  keys = {}
+  representatives = {}
+  for name, subsets in missing:
+    key = (font_file_digest(name), subsets)
+    keys[name] = key
+    representatives.setdefault(key, (name, subsets))
+
+  if representatives:
+    results = {}
+    with multiprocessing.Pool() as pool:
+      for name, values in pool.imap_unordered(_darkness_and_width_worker,
+                                              representatives.values(),
+                                              chunksize=8):
+        results[keys[name]] = values
+
+    for name, subsets in missing:
+      measured[name] = results[keys[name]]
+
+    cache = open_measurements_cache()
+    if cache is not None:
+      try:
+        for name, subsets in missing:
+          store_measurement(cache, name, subsets, stats[name], measured[name])
+        cache.commit()
+      except sqlite3.Error as e:
+        print("Could not update the measurements cache: {}".format(e))
+      cache.close()
+
+  names = list(measured)
+  darkness = [measured[name][0] for name in names]
+  width = [measured[name][1] for name in names]
+
+  weights = dict(zip(names, normalize_scores(darkness)))
+  widths = dict(zip(names, normalize_scores(width)))
   return weights, widths
 
 
 def save_csv(filename, metadata, cleanup_for_publishing=False):
-  with open(filename, 'w') as csvfile:
+  with open(filename, 'w', buffering=1<<20) as csvfile:
     writer = csv.writer(csvfile, delimiter=',', quotechar='"', lineterminator='\n')
     header = ["GFN","FWE","FIA","FWI","USAGE"]
     if not cleanup_for_publishing:
       header.append('SUBSETS')
-    writer.writerow(header) # first row has the headers
+    rows = [header] # first row has the headers
 
     for gfn in sorted(metadata.keys()):
       data = metadata[gfn]
@@ -76,7 +195,9 @@ def save_csv(filename, metadata, cleanup_for_publishing=False):
       if not cleanup_for_publishing:
         row.append(data['subsets'])
 
-      writer.writerow(row)
+      rows.append(row)
+
+    writer.writerows(rows)
 
 
 def read_csv(filename):
@@ -127,13 +248,12 @@ BLOCKLIST = [
   "Rubik-Regular",
 ]
 
+# A single pattern matching any of the blocklisted names:
+_BLOCKLIST_RE = re.compile("|".join(re.escape(name) for name in BLOCKLIST))
+
 def is_blocklisted(filename):
   """Returns whether a font is on the blocklist."""
-
-  # first check for explicit blocklisting:
-  for name in BLOCKLIST:
-    if name in filename:
-      return True
+  return _BLOCKLIST_RE.search(filename) is not None
 
 # Sample code below was copied from
 # https://www.cairographics.org/cookbook/freetypepython/
@@ -242,7 +362,33 @@ FONT_SIZE=30
 # The text used to test weight and width. Note that this could be
 # problematic if a given font doesn't have latin support.
 LATIN_TEXT = "AaBbCcDdEeFfGgHhIiJjKkLlMmNnOoPpQqRrSsTtUuVvXxYyZz"
-KHMER_TEXT = "\xE1\x9E\x9A\xE1\x9E\x9B\xE1\x9E\x80\xE1\x9E\x94\xE1\x9E\x80\xE1\x9F\x8B\xE1\x9E\x94\xE1\x9F\x84\xE1\x9E\x80\xE1\x9E\x93\xE1\x9E\xB6\xE1\x9E\x9B\xE1\x9F\x92\xE1\x9E\x84\xE1\x9E\xB6\xE1\x9E\x85\xE1\x9E\x8A\xE1\x9F\x8F\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x84\xE1\x9E\x85\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x82\xE1\x9E\x84"
+KHMER_TEXT = "រលកបក់បោកនាល្ងាចដ៏កណ្តោចកណ្តែង"
+
+
+# Text extents are measured on this surface, which is never drawn into:
+_MEASURING_SURFACE = cairo.ImageSurface(cairo.FORMAT_A8, 0, 0)
+
+# Sample texts are rendered on a single canvas per process, which is only
+# reallocated when a font needs more room than any previous one did:
+_canvas = None
+def _get_canvas(width, height):
+  """Returns the canvas surface and a context for drawing on it,
+     clipped to a freshly cleared width x height region."""
+  global _canvas
+  if _canvas is None or _canvas.get_width() < width or _canvas.get_height() < height:
+    canvas_width, canvas_height = width, height
+    if _canvas is not None:
+      canvas_width = max(width, _canvas.get_width())
+      canvas_height = max(height, _canvas.get_height())
+    _canvas = cairo.ImageSurface(cairo.FORMAT_A8, canvas_width, canvas_height)
+
+  ctx = cairo.Context(_canvas)
+  ctx.rectangle(0, 0, width, height)
+  ctx.clip()
+  ctx.set_operator(cairo.OPERATOR_CLEAR)
+  ctx.paint()
+  ctx.set_operator(cairo.OPERATOR_OVER)
+  return _canvas, ctx
 
 
 def compute_darkness_and_width(fontfile, subsets):
@@ -259,43 +405,41 @@ def compute_darkness_and_width(fontfile, subsets):
   # instead of just the khmer special case below:
   if 'khmer' in subsets:
     sample_text = KHMER_TEXT
-    sample_xheight = '\xE1\x9E\x85'
+    sample_xheight = 'ច'
   else:
     sample_text = LATIN_TEXT
     sample_xheight = 'x'
 
   face = create_cairo_font_face_for_file(fontfile, 0)
 
+  # Only coverage matters here, so we render into 8-bit alpha-only
+  # surfaces rather than ARGB32 ones.
+
   #dummy surface
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
-  ctx = cairo.Context(surface)
+  ctx = cairo.Context(_MEASURING_SURFACE)
   ctx.set_font_face(face)
   ctx.set_font_size(FONT_SIZE)
   xbearing, ybearing, text_width, text_height, _, _ = ctx.text_extents(sample_text)
   _, _, _, x_height, _, _ = ctx.text_extents(sample_xheight)
 
-
   #actual surface
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(text_width), int(text_height))
-  ctx = cairo.Context(surface)
+  data_width = int(text_width)
+  data_height = int(text_height)
+  surface, ctx = _get_canvas(data_width, data_height)
 
   ctx.set_font_face(face)
   ctx.set_font_size(FONT_SIZE)
   ctx.move_to(-xbearing, -ybearing)
   ctx.show_text(sample_text)
 
-  pixel_data = surface.get_data()
-  data_width = surface.get_width()
+  surface.flush()
   data_stride = surface.get_stride()
-  data_height = surface.get_height()
-
-  avg = 0.0
-  for x in xrange(data_width):
-    for y in xrange(data_height):
-      alpha = ord(pixel_data[y*data_stride + 4*x + 3])
-      avg += alpha/255.0
 
-  darkness = avg / (data_width * data_height)
+  # Sum the alpha of every pixel in a single numpy reduction
+  # instead of visiting each pixel from the interpreter:
+  pixels = np.frombuffer(surface.get_data(), dtype=np.uint8)
+  alpha = pixels.reshape(surface.get_height(), data_stride)[:data_height, :data_width]
+  darkness = alpha.sum(dtype=np.uint64) / (255.0 * data_width * data_height)
 
   width = text_width / float(x_height)
 